@@ -9,9 +9,28 @@ DISCORD_WEBHOOK_URL="https://discord.com/api/webhooks/00000000/xxxxxxxxxxxx"
 # アラートを発動させるディスク使用率のしきい値 (%)
 ALERT_THRESHOLD=95
 
-# VMホスト名リストの取得コマンド
+# VMホスト名リストを1行1ホストで出力する関数
 # これは一例で、権威DNSにmynk_hosts.txtという自己ゾーン転送によって得られたホスト名をテキストファイルにリストとしてまとめて取得できるようにしてある mynk.homeはローカルなドメイン名
-HOST_LIST_CMD="curl -s --fail http://ns.mynk.home/mynk_hosts.txt | awk '{print \$1}' | sort -u"
+# 重複と空行は awk で取り除いている
+list_hosts() {
+    curl -s --fail http://ns.mynk.home/mynk_hosts.txt | awk 'NF && !seen[$1]++ { print $1 }'
+}
+
+# 同時にチェックするホスト数の上限
+# 1台ずつ順番に見ると、落ちているホストの数だけタイムアウト待ちが積み上がるので並列で問い合わせる
+MAX_PARALLEL=16
+
+# node_exporter への接続待ち / 応答全体の待ち時間の上限 (秒)
+CONNECT_TIMEOUT=2
+MAX_TIME=10
+
+# "no exporter" だったホストを覚えておき、この秒数のあいだは問い合わせずに前回の結果を使う (0 で無効。既定は無効)
+# ホスト名リストには VM 以外のホストも混ざっていて毎回必ずエラーになるので、そこへの接続を省きたいとき用
+# キャッシュ中のホストはディスクのチェックもアラートもされないので、有効にするなら数分程度にしておく
+# (テンプレートから作った VM が node_exporter の起動前に見られると、その間は監視から外れる)
+# キャッシュから出した行は report.txt で "(cached)" 付きになる
+ERROR_CACHE_TTL=0
+ERROR_CACHE_FILE="${XDG_CACHE_HOME:-$HOME/.cache}/vm_diskcheck/error_hosts.tsv"
 
 #==============================================================================
 # 1. 必要なコマンドの存在チェック
@@ -24,72 +43,187 @@ fi
 #==============================================================================
 # 2. メイン処理
 #==============================================================================
+# node_exporter に問い合わせるときの curl のオプション。全ホストで同じなので最初に1回だけ組み立てる
+# URL の [] を curl のURLグロブと解釈されないように -g を付けている
+# cron から動かしたときに ~/.curlrc や *_proxy の環境変数で挙動が変わらないよう、-q (必ず先頭) と --noproxy で無視させる
+# (LAN 内のホストに直接つなぐだけなので、プロキシを経由させると遅くなるか、つながらないだけ)
+# 失敗の理由 (接続拒否かどうか) は終了コードだけでは分からないので、-v で接続の経過を標準エラーに出させる
+METRICS_CURL_OPTS=(-q -s -v -g --noproxy '*' --connect-timeout "$CONNECT_TIMEOUT" --max-time "$MAX_TIME")
+
+# curl のログや report.txt を置く作業ディレクトリ。終了時にまとめて消す
+work_dir=$(mktemp -d)
+trap 'rm -rf "$work_dir"' EXIT
+
+# node_exporter のメトリクス (標準入力) から / の使用量を1レコード出す
+# 通信はせず入力を読むだけなので、取得方法が変わってもこのまま使える
+# レコードは「状態<TAB>ホスト<TAB>使用率(%)<TAB>使用量<TAB>容量」(バイト) で、状態は ok か urgent
+# 表示用の整形はレポートを書くときに1回だけやる
+parse_root_usage() {
+    local host=$1
+
+    # 見るのは / だけなので、mountpoint="/" の行だけを正規表現1つで拾う。値は行末のフィールド
+    # しきい値の判定もここでやる
+    awk -v host="$host" -v threshold="$ALERT_THRESHOLD" '
+        !/mountpoint="\/"[,}]/ { next }
+        /^node_filesystem_size_bytes\{/ { size = $NF }
+        /^node_filesystem_avail_bytes\{/ { avail = $NF }
+        END {
+            if (size > 0 && avail != "") {
+                used = size - avail
+                # 表示と同じく小数1桁に丸めた値でしきい値と比べる
+                pct = sprintf("%.1f", (used / size) * 100)
+                printf "%s\t%s\t%s\t%.0f\t%.0f\n", (pct + 0 >= threshold ? "urgent" : "ok"), host, pct, used, size
+            }
+        }'
+}
+
+# 1ホスト分のチェック。parse_root_usage と同じレコードを1行だけ標準出力に書く
+check_host() {
+    local host=$1
+    local record error_msg curl_status
+    local curl_log="${work_dir}/${host}.curl.log"
+
+    #9100が確かnode_exporterを入れたノードのメトリクス表示するやつ
+    # collect[]=filesystem で filesystem コレクタだけ動かしてもらう (CPU やネットワークの分は集めさせない)
+    # メトリクスはそのまま parse_root_usage へ流し、受信しながら読ませる
+    # pipefail で curl の終了コードを拾う (parse_root_usage 側は失敗しない)
+    # curl の標準エラー (-v の出力) は失敗の理由を調べるためにファイルに残す
+    record=$(set -o pipefail
+        LC_ALL=C curl "${METRICS_CURL_OPTS[@]}" "http://${host}:9100/metrics?collect[]=filesystem" 2> "$curl_log" | \
+            parse_root_usage "$host")
+    curl_status=$?
+
+    if [ $curl_status -eq 0 ]; then
+        if [ -n "$record" ]; then
+            echo "$record"
+        fi
+    else
+        # 接続拒否 (ECONNREFUSED) のときだけ、ホストは生きているが 9100 で誰も待っていないと判断する
+        # curl の終了コード 7 は到達不能 (EHOSTUNREACH など) のときも返るので、-v の出力で見分ける
+        # 文言は英語で固定したいので curl は LC_ALL=C で動かしている (ja_JP だと「接続を拒否されました」になり一致しない)
+        # それ以外の失敗 (タイムアウト・到達不能・名前解決失敗など) はすべて timeout 扱い
+        if [[ "$(< "$curl_log")" == *"Connection refused"* ]]; then
+            error_msg="Error: no exporter"
+        else
+            error_msg="Error: timeout"
+        fi
+        print_error "$host" "$error_msg"
+    fi
+}
+
+# エラーのレコード「error<TAB>ホスト<TAB>エラーメッセージ」を1行出す
+print_error() {
+    printf 'error\t%s\t%s\n' "$1" "$2"
+}
+
+# ERROR_CACHE_FILE (ホスト名<TAB>記録時刻) のうち、まだ ERROR_CACHE_TTL を過ぎていないものを cached_errors に読み込む
+load_error_cache() {
+    local host ts
+
+    if (( ERROR_CACHE_TTL <= 0 )) || [ ! -r "$ERROR_CACHE_FILE" ]; then
+        return 0
+    fi
+    while IFS=$'\t' read -r host ts; do
+        if [[ "$ts" =~ ^[0-9]+$ ]] && (( ts <= now && now - ts < ERROR_CACHE_TTL )); then
+            cached_errors[$host]=$ts
+        fi
+    done < "$ERROR_CACHE_FILE"
+}
+
+# 途中で読まれても壊れた内容が見えないよう、一時ファイルに書いてから mv で置き換える
+save_error_cache() {
+    if (( ERROR_CACHE_TTL <= 0 )); then
+        return 0
+    fi
+    mkdir -p "${ERROR_CACHE_FILE%/*}" &&
+        printf '%s' "$new_error_cache" > "${ERROR_CACHE_FILE}.$$" &&
+        mv -f "${ERROR_CACHE_FILE}.$$" "$ERROR_CACHE_FILE"
+}
+
+# 標準入力のホスト名ごとに check_host をバックグラウンドで走らせる (同時実行は最大 MAX_PARALLEL)
+run_checks() {
+    local host
+    local running=0
+
+    while read -r host; do
+        if [ -n "${cached_errors[$host]}" ]; then
+            print_error "$host" "Error: no exporter (cached)"
+            continue
+        fi
+        if (( running >= MAX_PARALLEL )); then
+            wait -n
+            running=$((running - 1))
+        fi
+        check_host "$host" &
+        running=$((running + 1))
+    done
+    wait
+}
+
 all_results=""
 urgent_hosts=""
 has_urgent_host=false
+# 集計は結果を受け取るループの中で数える
+total_count=0
+error_count=0
+urgent_count=0
 
-while read -r host; do
-    #9100が確かnode_exporterを入れたノードのメトリクス表示するやつ
-    metrics=$(curl -s --connect-timeout 2 "http://${host}:9100/metrics")
-
-    if [ $? -eq 0 ]; then
-        result_line=$(echo "$metrics" | \
-            grep -E 'node_filesystem_(size|avail)_bytes' | \
-            awk -v host="$host" '
-            BEGIN { FS="} " }
-            /node_filesystem_size_bytes/ { gsub(/.*mountpoint="/, "", $1); gsub(/".*/, "", $1); size[$1] = $2 }
-            /node_filesystem_avail_bytes/ { gsub(/.*mountpoint="/, "", $1); gsub(/".*/, "", $1); avail[$1] = $2 }
-            END {
-                mount = "/"
-                if (size[mount] > 0 && avail[mount] != "") {
-                    used = size[mount] - avail[mount]
-                    pct = (used / size[mount]) * 100
-                    used_gb = used / (1024*1024*1024)
-                    size_gb = size[mount] / (1024*1024*1024)
-                    # ★修正点: 全ての列のフォーマットを統一
-                    printf "%-25s | %12s | %12s | %8s", host, sprintf("%.2f GB", used_gb), sprintf("%.2f GB", size_gb), sprintf("%.1f%%", pct)
-                }
-            }')
-        
-        if [ -n "$result_line" ]; then
-            # ★修正点: 改行を確実に追加する
-            all_results="${all_results}${result_line}\n"
-            percentage=$(echo "$result_line" | awk -F'|' '{print $4}' | tr -d ' %')
-            
-            if (( $(echo "$percentage >= $ALERT_THRESHOLD" | bc -l) )); then
-                has_urgent_host=true
-                alert_line=$(echo "$result_line" | awk -F'|' '{printf "%-25s | 使用率: %.1f%%", $1, $4}')
-                urgent_hosts="${urgent_hosts}${alert_line}\n"
-            fi
+printf -v now '%(%s)T' -1
+declare -A cached_errors
+new_error_cache=""
+load_error_cache
+
+# 各ホストのチェックは最大 MAX_PARALLEL 並列で走らせ、終わった順に1レコードずつ受け取る
+# error のレコードでは pct の位置にエラーメッセージが入る
+while IFS= read -r record; do
+    IFS=$'\t' read -r status host pct used size <<< "$record"
+    # ★修正点: 改行を確実に追加する
+    all_results+="${record}"$'\n'
+    total_count=$((total_count + 1))
+
+    if [ "$status" = error ]; then
+        error_count=$((error_count + 1))
+        if [[ "$pct" == "Error: no exporter"* ]]; then
+            # キャッシュから出したものは最初に記録した時刻のまま引き継ぎ、TTL が来たら問い合わせ直す
+            new_error_cache+="${host}"$'\t'"${cached_errors[$host]:-$now}"$'\n'
         fi
-    else
-        error_msg=$(ping -c 1 -W 1 "$host" &> /dev/null && echo "Error: no exporter" || echo "Error: timeout")
-        # ★修正点: エラー行もデータ行とフォーマットを完全に一致させる
-        error_line=$(printf '%-25s | %12s | %12s | %s' "$host" "" "" "$error_msg")
-        all_results="${all_results}${error_line}\n"
+    elif [ "$status" = urgent ]; then
+        has_urgent_host=true
+        urgent_count=$((urgent_count + 1))
+        printf -v alert_line '%-25s  | 使用率: %s%%' "$host" "$pct"
+        urgent_hosts+="${alert_line}"$'\n'
     fi
-done < <(eval $HOST_LIST_CMD)
+done < <(list_hosts | run_checks)
+
+save_error_cache
 
 #==============================================================================
 # 3. Discord通知
 #==============================================================================
 if [ -n "$all_results" ]; then
-    report_file=$(mktemp)
-    trap 'rm -f "$report_file"' EXIT
+    report_file="${work_dir}/report.txt"
 
-    # ★修正点: ヘッダーもデータ行とフォーマットを完全に一致させる
-    header=$(printf "%-25s | %-12s | %-12s | %-8s\n" "Host" "Used" "Total" "Usage %")
     separator="--------------------------|--------------|--------------|---------"
-    
-    echo -e "${header}\n${separator}" > "$report_file"
-    # `printf "%b"` を使って変数内の `\n` を確実に解釈させる
-    printf "%b" "$all_results" | sed '/^$/d' | sort -t'|' -k4 -hr >> "$report_file"
 
-    total_count=$(printf "%b" "$all_results" | sed '/^$/d' | wc -l | tr -d ' ')
-    error_count=$(printf "%b" "$all_results" | grep -c "Error:")
-    urgent_count=$(echo -e "$urgent_hosts" | sed '/^$/d' | wc -l | tr -d ' ')
+    # ヘッダー・区切り線・データ行を1回のリダイレクトでまとめて書き出す
+    {
+        # ★修正点: ヘッダーもデータ行とフォーマットを完全に一致させる
+        printf "%-25s | %-12s | %-12s | %-8s\n" "Host" "Used" "Total" "Usage %"
+        echo "$separator"
+        # all_results は1レコード1行なので、そのまま sort に渡す
+        # 使用率の高い順に並べ (エラーは数値にならないので末尾に来る)、ここで初めて表示用に整形する
+        printf '%s' "$all_results" | sort -t$'\t' -k3,3gr -r | \
+            awk -F'\t' '
+            # ★修正点: エラー行もデータ行とフォーマットを完全に一致させる
+            $1 == "error" { printf "%-25s | %12s | %12s | %s\n", $2, "", "", $3; next }
+            # ★修正点: 全ての列のフォーマットを統一
+            {
+                printf "%-25s | %12s | %12s | %8s\n", $2, sprintf("%.2f GB", $4 / (1024*1024*1024)), sprintf("%.2f GB", $5 / (1024*1024*1024)), $3 "%"
+            }'
+    } > "$report_file"
 
-    summary_embed=$(jq -n \
+    # jq の出力はそのまま curl の標準入力に流す
+    jq -nc \
       --arg total "$total_count" \
       --arg errors "$error_count" \
       --arg urgent "$urgent_count" \
@@ -104,19 +238,19 @@ if [ -n "$all_results" ]; then
           ],
           "footer": {"text": "詳細は添付の report.txt をご確認ください。"}
         }]
-      }')
-
+      }' | \
     curl -s -H "Accept: application/json" \
-         -F "payload_json=${summary_embed}" \
+         -F "payload_json=<-" \
          -F "file1=@${report_file};filename=report.txt" \
          "$DISCORD_WEBHOOK_URL" > /dev/null 2>&1
 fi
 
 if [ "$has_urgent_host" = true ]; then
-    timestamp=$(date -u +%Y-%m-%dT%H:%M:%S.000Z)
-    
-    json_embed=$(jq -n \
-      --arg description "$(echo -e "$urgent_hosts")" \
+    # bash 組み込みの printf で UTC の時刻を作る
+    TZ=UTC0 printf -v timestamp '%(%Y-%m-%dT%H:%M:%S.000Z)T' -1
+
+    jq -nc \
+      --arg description "${urgent_hosts%$'\n'}" \
       --arg ts "$timestamp" \
       '{
         "content": "@everyone ディスク使用率が'${ALERT_THRESHOLD}'%を超えたサーバーがあります！",
@@ -126,7 +260,6 @@ if [ "$has_urgent_host" = true ]; then
             "color": 15158332,
             "timestamp": $ts
         }]
-      }')
-
-    curl -s -H "Content-Type: application/json" -X POST -d "$json_embed" "$DISCORD_WEBHOOK_URL" > /dev/null 2>&1
+      }' | \
+    curl -s -H "Content-Type: application/json" -X POST --data-binary @- "$DISCORD_WEBHOOK_URL" > /dev/null 2>&1
 fi